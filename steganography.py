@@ -1,14 +1,16 @@
 ''' Creation Date: 27/08/2022 '''
 
 
+import numpy as np
 from PIL import Image
 from os import getenv
-from functools import reduce
-from itertools import product
-from secrets import token_hex
+from functools import lru_cache
 from dotenv import load_dotenv
 from os.path import exists, splitext
-from random import seed, sample, randint
+try: # Optional, compiles the bit writing loop when installed
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 def verify_string(items: list):
@@ -19,19 +21,21 @@ def verify_string(items: list):
 
 
 def load_image(filename: str, type: str = '.png'):
-    ''' Returns: Image object and class of width, height, and size. '''
+    ''' Returns: Decoded pixel array and class of width, height, and size. '''
     if not filename.endswith(type): # Only support PNG
         filename += type
     try:
         image = Image.open(f'Files/{filename}')
     except Exception as e:
         raise ValueError(f'No .png at Files/{filename}') from e
-    size = image.size
+    with image: # Decode once up front and release the file
+        pixels = np.array(image)
+        size = image.size
     class Size():
         WIDTH = size[0]
         HEIGHT = size[1]
         PIXELS = size[0] * size[1]
-    return image, Size
+    return pixels, Size
 
 
 def env_extract():
@@ -43,78 +47,64 @@ def env_extract():
     return getenv('ENVIRONMENTKEY')
 
 
-def shuffle(key: int, data):
-    ''' Returns: Data shuffled with key as seed. '''
-    seed(key) # Same result with same key and data
-    return sample(data, len(data))
+def shuffle(rng: np.random.Generator, data: np.ndarray):
+    ''' Returns: Data shuffled with generator, same result with same seed and data. '''
+    return data[rng.permutation(len(data))]
 
 
 def decimal_encoding(text: str):
     ''' Returns: Text converted to base10 integer. '''
     try:
-        return int(reduce(lambda a, b: a * 256 + b, map(ord, text), 0))
+        return int.from_bytes(text.encode('utf-8'), 'big')
     except Exception as e:
         raise ValueError(f'Failed to encode: {text}') from e
 
 
-def generate_context(key: int, Image: Image, Size: object, key_pixels: int = 16):
-    ''' Returns: List of tuple coordinates in image and image specific key. '''
-    coords = [*product(range(Size.WIDTH), range(Size.HEIGHT))]
+@lru_cache(maxsize=8)
+def image_coords(width: int, height: int):
+    ''' Returns: Read only array of every (Width, Height) coordinate, cached by size. '''
+    coords = np.stack(np.meshgrid(np.arange(width, dtype=np.int32),
+                                  np.arange(height, dtype=np.int32)), -1).reshape(-1, 2)
+    coords.flags.writeable = False # Shared between calls, shuffle returns copies
+    return coords
+
+
+def generate_context(key: int, pixels: np.ndarray, Size: object, key_pixels: int = 16):
+    ''' Returns: Array of (Width, Height) coordinates and image specific generator. '''
+    pixel_coords = image_coords(Size.WIDTH, Size.HEIGHT)
     environment_key = decimal_encoding(env_extract())
-    coords = shuffle(environment_key, coords)
+    coords = shuffle(np.random.default_rng(environment_key), pixel_coords)
     key = decimal_encoding(key)
     key *= (Size.PIXELS * 99) # Adjust key by image size
-    coords = shuffle(key, [*product(range(Size.WIDTH), range(Size.HEIGHT))])
-    pixels = [Image.getpixel((coords[point][0], coords[point][1]))
-              for point in range(key_pixels - 1)]
-    key *= (sum(map(sum, pixels))) # Adjust key by key pixels
-    coords = shuffle(key, coords[key_pixels:])
-    return coords, key
-
-
-def generate_header(Config: object):
-    ''' Returns: Built binary header data specifying settings. '''
-    method_bin = '1' if Config.METHOD == 'random' else '0'
-    stored_bin = '1' if Config.STORED == 'data' else '0'
-    encrypt_bin = '1' if Config.ENCRYPT == True else '0'
-    colour_table = ['0', '0', '0']
-    for colour in Config.COLOURS:
-        colour_table[colour] = '1'
-    colour_bin = ''.join(colour_table)
-    index_table = ['0', '0', '0', '0', '0', '0', '0', '0']
-    for index in Config.INDEXS:
-        index_table[index] = '1'
-    index_bin = ''.join(index_table)
-    return method_bin + stored_bin + encrypt_bin + colour_bin + index_bin
-
-
-def random_sample(key: int, options: list, length: int, number_picked: int = 1):
-    ''' Returns: Variable length list of lists of selected options. '''
-    seed(key)
-    return [sample(options, k = number_picked) for _ in range(length)]
-
-
-def integer_conversion(data: int, method: str):
-    ''' Returns: Number converted to or from binary. '''
-    if method == 'binary':
-        return bin(data).replace('0b', '').zfill(8)
-    else:
-        return int(data, 2)
-
-
-def attach_header(Image: Image, key: int, header: str, coords: list):
-    ''' Returns: Modified image with header data attached for extraction. '''
+    coords = shuffle(np.random.default_rng(key), coords)
+    xs, ys = coords[:key_pixels - 1].T
+    key *= int(pixels[ys, xs].sum()) # Adjust key by key pixels
+    rng = np.random.default_rng(key) # Seeded once, later draws must match on extract
+    coords = shuffle(rng, coords[key_pixels:])
+    return coords, rng
+
+
+def random_sample(rng: np.random.Generator, options: list, length: int):
+    ''' Returns: Variable length array of one selected option per position. '''
+    return rng.choice(options, size=length)
+
+
+def attach_header(pixels: np.ndarray, rng: np.random.Generator, Config: object,
+                  coords: np.ndarray):
+    ''' Returns: Modified pixels with settings header attached for extraction. '''
     LENGTH = 14 # Stored as random method, any colour, smallest index
-    header_coords = coords[:LENGTH]
-    colours = random_sample(key, [0,1,2], LENGTH)
-    colours = [item for sublist in colours for item in sublist]
-    for i, position in enumerate(header_coords):
-        pixel = list(Image.getpixel((position[0], position[1])))
-        value = integer_conversion(pixel[colours[i]], 'binary')
-        modified_value = integer_conversion(value[:-1] + header[i], 'integer')
-        pixel[colours[i]] = modified_value 
-        Image.putpixel((coords[i][0], coords[i][1]), tuple(pixel))
-    return coords[LENGTH:], Image    
+    method_bit = Config.METHOD == 'random'
+    stored_bit = Config.STORED == 'data'
+    encrypt_bit = Config.ENCRYPT == True
+    colour_mask = sum(1 << (2 - colour) for colour in Config.COLOURS)
+    index_mask = sum(1 << (7 - index) for index in Config.INDEXS)
+    header = method_bit << 13 | stored_bit << 12 | encrypt_bit << 11 \
+             | colour_mask << 8 | index_mask
+    xs, ys = coords[:LENGTH].T
+    colours = random_sample(rng, [0,1,2], LENGTH)
+    bits = (header >> np.arange(LENGTH - 1, -1, -1)) & 1 # Highest bit first
+    pixels[ys, xs, colours] = (pixels[ys, xs, colours] & 0xFE) | bits.astype(np.uint8)
+    return coords[LENGTH:], pixels
 
 
 def list_verification(variable: str, items: list, allowed: list):
@@ -139,8 +129,8 @@ def str_verification(variable: str, value: str, allowed: list):
         raise ValueError(f'Invalid string {variable} argument: {value}')
 
 
-def build_object(key: int, method: str, stored: str, encrypt: bool, 
-                 colours: list, indexs: list, noise: bool = False):
+def build_object(method: str, stored: str, encrypt: bool, colours: list,
+                 indexs: list, noise: bool = False):
     ''' Returns: Configuration object of steganographic storage settings. '''
     if colours is None:
         colours = [0, 1, 2]
@@ -152,6 +142,8 @@ def build_object(key: int, method: str, stored: str, encrypt: bool,
     list_verification('colours', colours, [0,1,2])
     bool_verification('encrypt', encrypt)
     bool_verification('noise', noise)
+    colours = sorted(set(colours)) # Match the header, which holds one flag per option
+    indexs = sorted(set(indexs))
     class Config:
         VOLUME = len(colours) * len(indexs) if method == 'all' else len(indexs)
         COLOURS = colours
@@ -160,24 +152,26 @@ def build_object(key: int, method: str, stored: str, encrypt: bool,
         INDEXS = indexs
         METHOD = method
         NOISE = noise
-        KEY = key
     return Config
 
 
-def binary_encode(data: str, Config: object):
-    ''' Returns: File at data or string of data convert to binary. '''
+def read_data(data: str, Config: object):
+    ''' Returns: File at data or string of data as bytes. '''
     if Config.STORED == 'file':
         file_details = data.encode('utf-8') + b'..'
         with open(f'Files/{data}', 'rb') as file:
-            data_bytes = file_details + file.read()
-    else:
-        data_bytes = data.encode('utf-8')
-    return ''.join(f'{byte:08b}' for byte in data_bytes)
+            return file_details + file.read()
+    return data.encode('utf-8')
 
 
-def binary_decode(data: str, Config: object, overwrite: bool):
-    ''' Returns: Binary string converted to file or string of data. '''
-    data_bytes = int(data, 2).to_bytes((len(data) + 7) // 8, byteorder='big')
+def binary_encode(data_bytes: bytes):
+    ''' Returns: Bytes converted to binary array. '''
+    return np.unpackbits(np.frombuffer(data_bytes, dtype=np.uint8))
+
+
+def binary_decode(data: np.ndarray, Config: object, overwrite: bool):
+    ''' Returns: Binary array converted to file or string of data. '''
+    data_bytes = np.packbits(data).tobytes()
     if Config.STORED != 'file':
         print(data_bytes.decode('utf-8')) # Print to terminal
     file_bytes, data_bytes = data_bytes.split(b'..', 1)
@@ -190,53 +184,69 @@ def binary_decode(data: str, Config: object, overwrite: bool):
         file.close()
 
 
-def generate_numbers(min_value: int, max_value: int, number_values: int):
-    ''' Returns: Variable length string of random numbers in range. '''
-    seed(token_hex(64))
-    return ''.join([str(randint(min_value, max_value)) for _ in range(number_values)])
-
-
-def generate_message(Config: object, data: str, coords: list):
-    ''' Returns: Generated binary data to be attached to image. '''
-    capacity = len(coords)
-    data = binary_encode(data, Config)
-    end_key_size = len(integer_conversion(capacity, 'binary'))
-    data_size = len(data)
+def generate_message(Config: object, data: str, coords: np.ndarray):
+    ''' Returns: Generated binary array to be attached to image. '''
+    capacity = coords.shape[1]
+    data_bytes = read_data(data, Config)
+    end_key_size = max(capacity.bit_length(), 8) # Bits to count capacity, at least a byte
+    data_size = len(data_bytes) * 8
     size = end_key_size + data_size
-    if size > capacity: # Test if message can fit inside the image
+    if size > capacity: # Test if message can fit before converting it
         raise ValueError(f'Message size exceeded by {size - capacity} bits')
-    noise = generate_numbers(0, 1, capacity - size) if Config.NOISE else ''
-    end_key = integer_conversion(data_size, 'binary').zfill(end_key_size)
-    return end_key + data + noise # Binary, end key specifies index of data end
-
-
-def generate_coords(Config: object, Size: object, pixel_coords: list):
-    ''' Returns: Shuffled data location tuples (Width, Height, Colour, Index). '''
-    if Config.METHOD == 'random': # If random need to pick random colour option per pixel
-        if len(Config.COLOURS) == 1: # Don't random sample if only one colour option
-            colours = [Config.COLOURS] * Size.PIXELS
-        else:
-            colours = random_sample(Config.KEY, Config.COLOURS, Size.PIXELS)
-    data_coords = []
-    for i, coordinate in enumerate(pixel_coords):
-        for colour in colours[i] if Config.METHOD == 'random' else Config.COLOURS:
-            data_coords.extend((coordinate[0], coordinate[1], colour, index) 
-                               for index in Config.INDEXS)
-    return shuffle(Config.KEY, data_coords)
-
-
-def attach_data(Image: Image, Config: object, binary_message: str, coords: list):
-    ''' Returns: Image with all required pixels steganographically modified. '''
+    end_key = np.unpackbits(np.array([data_size], dtype='>u8').view(np.uint8))[-end_key_size:]
+    message = [end_key, binary_encode(data_bytes)] # End key specifies index of data end
+    if Config.NOISE: # Fresh entropy, noise is not tied to the key
+        message.append(np.random.default_rng().integers(0, 2, capacity - size, dtype=np.uint8))
+    return np.concatenate(message)
+
+
+def generate_coords(Config: object, rng: np.random.Generator, pixel_coords: np.ndarray):
+    ''' Returns: Shuffled data location arrays of (Width, Height, Colour, Index). '''
+    if Config.METHOD == 'random' and not Config.COLOURS: # Each pixel needs one colour
+        raise ValueError(f'Invalid colours list argument: {Config.COLOURS}')
+    if Config.METHOD == 'random' and len(Config.COLOURS) > 1: # Pick colour per pixel
+        colours = random_sample(rng, Config.COLOURS, len(pixel_coords))
+    else: # Every pixel uses every colour option, including a lone random option
+        colours = np.tile(np.array(Config.COLOURS, dtype=np.int32), len(pixel_coords))
+    indexs = np.array(Config.INDEXS, dtype=np.int32)
+    data_coords = np.empty((4, len(pixel_coords) * Config.VOLUME), dtype=np.int32)
+    data_coords[0] = np.repeat(pixel_coords[:, 0], Config.VOLUME)
+    data_coords[1] = np.repeat(pixel_coords[:, 1], Config.VOLUME)
+    data_coords[2] = np.repeat(colours, len(indexs))
+    data_coords[3] = np.tile(indexs, len(colours))
+    order = shuffle(rng, np.arange(data_coords.shape[1]))
+    return data_coords[:, order] # Parallel rows share one permutation
+
+
+if njit is None:
+    def write_bits(flat: np.ndarray, positions: np.ndarray, masks: np.ndarray,
+                   bits: np.ndarray):
+        ''' Purpose: Set masked bit of values at positions, positions may repeat. '''
+        for mask in np.uint8(1) << np.arange(8, dtype=np.uint8): # One pass per index,
+            chosen = masks == mask # positions only repeat across different indexs
+            spots = positions[chosen]
+            flat[spots] = (flat[spots] & ~mask) | (bits[chosen] * mask)
+else:
+    @njit(cache=True) # Serial, parallel writes would race on shared values
+    def write_bits(flat: np.ndarray, positions: np.ndarray, masks: np.ndarray,
+                   bits: np.ndarray):
+        ''' Purpose: Set masked bit of values at positions, positions may repeat. '''
+        for i in range(positions.shape[0]):
+            flat[positions[i]] = (flat[positions[i]] & ~masks[i]) | (bits[i] * masks[i])
+
+
+def attach_data(pixels: np.ndarray, Config: object, binary_message: np.ndarray,
+                coords: np.ndarray):
+    ''' Returns: Pixels with all required values steganographically modified. '''
     if not Config.NOISE: # Optimise if not modifying every pixel
-        coords = coords[:len(binary_message)]
-    for i, position in enumerate(coords):
-        pixel = list(Image.getpixel((position[0], position[1])))
-        value = list(integer_conversion(pixel[position[2]], 'binary'))
-        value[position[3]] = binary_message[i]
-        modified_value = integer_conversion(''.join(value), 'integer')
-        pixel[position[2]] = modified_value
-        Image.putpixel((coords[i][0], coords[i][1]), tuple(pixel))
-    return Image
+        coords = coords[:, :len(binary_message)]
+    xs, ys, cs, idxs = coords
+    flat = pixels.reshape(-1) # View, so writes land in pixels
+    positions = np.ravel_multi_index((ys, xs, cs), pixels.shape) # As intp, int32 can wrap
+    masks = np.uint8(1) << (7 - idxs).astype(np.uint8)
+    write_bits(flat, positions, masks, binary_message)
+    return pixels
+
 
 def uniquify(file: str):
     ''' Returns: File path unique from existing files. '''
@@ -250,53 +260,46 @@ def uniquify(file: str):
     return file
 
 
-def save_image(filename: str, Image: Image, overwrite: bool, extension: str = '.png'):
+def save_image(filename: str, pixels: np.ndarray, overwrite: bool, extension: str = '.png'):
     ''' Returns: Saved image at location output. '''
     filename = f'Files/{filename[:-4]}_stego122{extension}' if filename.endswith(extension) \
                 else f'Files/{filename}_stego122{extension}'
     if not overwrite:
         filename = uniquify(f'{filename}')
-    Image.save(filename)
+    Image.fromarray(pixels).save(filename)
 
 
-def extract_header(Image: Image, key: int, coords: list):
+def extract_header(pixels: np.ndarray, rng: np.random.Generator, coords: np.ndarray):
     ''' Returns: Header data extracted and unpacked. '''
     LENGTH = 14 # Header coded to 1 for true, 0 for false
-    header_coords = coords[:LENGTH]
-    colours = random_sample(key, [0,1,2], LENGTH)
-    colours = [item for sublist in colours for item in sublist]
-    header = []
-    for i, position in enumerate(header_coords):
-        pixel = list(Image.getpixel((position[0], position[1])))
-        value = integer_conversion(pixel[colours[i]], 'binary')
-        header.append(value[-1])
-    method = 'random' if header[0] == '1' else 'all'
-    stored = 'data' if header[1] == '1' else 'file'
-    encrypt = header[2] == '1'
-    colours = [i for i in range(3) if header[i + 3] == '1']
-    indexs = [i for i in range(8) if header[i + 6] == '1']
+    xs, ys = coords[:LENGTH].T
+    colours = random_sample(rng, [0,1,2], LENGTH)
+    bits = pixels[ys, xs, colours] & 1
+    header = int(np.dot(bits, 1 << np.arange(LENGTH - 1, -1, -1))) # Highest bit first
+    method = 'random' if header >> 13 & 1 else 'all'
+    stored = 'data' if header >> 12 & 1 else 'file'
+    encrypt = header >> 11 & 1 == 1
+    colours = [i for i in range(3) if header >> (10 - i) & 1]
+    indexs = [i for i in range(8) if header >> (7 - i) & 1]
     return [method, stored, encrypt, colours, indexs], coords[LENGTH:]
 
 
-def extract_data(Image: Image, coords: list):
+def extract_data(pixels: np.ndarray, coords: np.ndarray):
     ''' Returns: All binary data extracted from given coordinates. '''
-    data = []
-    for position in coords:
-        pixel = list(Image.getpixel((position[0], position[1])))
-        value = list(integer_conversion(pixel[position[2]], 'binary'))
-        data.append(value[position[3]])
-    return ''.join(data)
+    xs, ys, cs, idxs = coords
+    return (pixels[ys, xs, cs] >> (7 - idxs).astype(np.uint8)) & 1
 
 
-def extract_message(Image: Image, coords: list):
+def extract_message(pixels: np.ndarray, coords: np.ndarray):
     ''' Returns: Data stored steganographically within the image. '''
-    capacity = len(coords)
-    end_key_size = len(integer_conversion(capacity, 'binary'))
+    capacity = coords.shape[1]
+    end_key_size = max(capacity.bit_length(), 8) # Bits to count capacity, at least a byte
     try:
-        end_key = extract_data(Image, coords[:end_key_size]) 
-        data_size = integer_conversion(end_key, 'integer')
-        coords = coords[end_key_size: data_size + end_key_size]
-        return extract_data(Image, coords)
+        end_key = extract_data(pixels, coords[:, :end_key_size])
+        data_size = int.from_bytes(np.packbits(end_key).tobytes(), 'big')
+        data_size >>= -end_key_size % 8 # Drop zero padding packbits added
+        coords = coords[:, end_key_size: data_size + end_key_size]
+        return extract_data(pixels, coords)
     except Exception as e:
         raise ValueError('Invalid data extracted') from e
 
@@ -306,24 +309,23 @@ def data_insert(filename: str, data: str, key: str = '999', method: str = 'rando
                 noise: bool = False, encrypt: bool = False, overwrite: bool = True):
     ''' Returns: Selected image with secret data steganographically attached. '''
     verify_string([filename, data, key])
-    Image, Size = load_image(filename)
-    coords, image_key = generate_context(key, Image, Size)
-    Config = build_object(image_key, method, stored, encrypt, colours, indexs, noise)
-    header = generate_header(Config) # Specifies Configuration for extract
-    cut_coords, Image = attach_header(Image, image_key, header, coords)
-    data_coords = generate_coords(Config, Size, cut_coords)
+    pixels, Size = load_image(filename)
+    coords, rng = generate_context(key, pixels, Size)
+    Config = build_object(method, stored, encrypt, colours, indexs, noise)
+    cut_coords, pixels = attach_header(pixels, rng, Config, coords) # Config for extract
+    data_coords = generate_coords(Config, rng, cut_coords)
     binary_message = generate_message(Config, data, data_coords)
-    Image = attach_data(Image, Config, binary_message, data_coords)
-    save_image(filename, Image, overwrite)
+    pixels = attach_data(pixels, Config, binary_message, data_coords)
+    save_image(filename, pixels, overwrite)
 
 
 def data_extract(filename: str, key: str = '999', overwrite: bool = True):
     ''' Returns: Data steganographically extracted from selected image. '''
     verify_string([filename, key])
-    Image, Size = load_image(filename)
-    coords, image_key = generate_context(key, Image, Size)
-    setup, cut_coords = extract_header(Image, image_key, coords)
-    Config = build_object(image_key, setup[0], setup[1], setup[2], setup[3], setup[4])
-    data_coords = generate_coords(Config, Size, cut_coords)
-    binary = extract_message(Image, data_coords)
+    pixels, Size = load_image(filename)
+    coords, rng = generate_context(key, pixels, Size)
+    setup, cut_coords = extract_header(pixels, rng, coords)
+    Config = build_object(setup[0], setup[1], setup[2], setup[3], setup[4])
+    data_coords = generate_coords(Config, rng, cut_coords)
+    binary = extract_message(pixels, data_coords)
     binary_decode(binary, Config, overwrite)